@@ -18,6 +18,7 @@ import sys
 import os
 import argparse
 from datetime import date
+import functools
 import glob
 import pathlib
 import re
@@ -112,19 +113,23 @@ def convert_prerelease_type_to_num(prerelease_type):
     return 9
 
 
+@functools.lru_cache(maxsize=4096)
 def parse_version(version):
-    """Converts a SemVer androidx version string into a list of ints.
+    """Converts a SemVer androidx version string into a tuple of ints.
 
     Accepts a SemVer androidx version string, such as "1.2.0-alpha02" and
-    returns a list of integers representing the version in the following format:
-    [<major>,<minor>,<bugfix>,<prerelease-suffix>,<prerelease-suffix-revision>]
-    For example 1.2.0-alpha02" returns [1,2,0,0,2]
+    returns a tuple of integers representing the version in the following format:
+    (<major>,<minor>,<bugfix>,<prerelease-suffix>,<prerelease-suffix-revision>)
+    For example 1.2.0-alpha02" returns (1,2,0,0,2)
+
+    The same version strings recur across the many libraries in a release, so
+    results are memoized; the tuple return type keeps cached values immutable.
 
     Args:
         version: the androidx version string.
 
     Returns:
-        a list of integers representing the version.
+        a tuple of integers representing the version.
     """
     version_elements = version.split('-')[0].split('.')
     version_list = []
@@ -144,7 +149,7 @@ def parse_version(version):
         version_list.append(99)
     else:
         version_list.append(int(version_prerelease_suffix_rev))
-    return version_list
+    return tuple(version_list)
 
 
 def get_higher_version(version_a, version_b):
@@ -35,6 +35,12 @@ A RELNOTE can be N/A for commit messages that only effects tooling, documentatio
 structure, etc., but not the release artifacts.
 """
 
+"""Following copied (with minor edits) from hooks.py:check_commit_msg_relnote_for_current_txt"""
+_RELNOTE_RE = re.compile(r'^Relnote: .+$', re.IGNORECASE | re.MULTILINE)
+
+_SRC_RE = re.compile(r'/src/(main|commonMain|androidMain)/')
+_BUILDSRC_RE = re.compile(r'(^|/)buildSrc/')
+
 def main(args=None):
     parser = argparse.ArgumentParser(
         prog="requirerelnote",
@@ -45,29 +51,16 @@ def main(args=None):
 
     args = parser.parse_args()
 
-    source_files = [f for f in args.file
-               if (not "buildSrc/" in f and
-                  "/src/main/" in f or
-                  "/src/commonMain/" in f or
-                  "/src/androidMain/" in f)]
-    module_files = [f for f in source_files
-                if (args.module in f)]
+    module_files = [f for f in args.file
+                if (args.module in f and
+                   _SRC_RE.search(f) and
+                   not _BUILDSRC_RE.search(f))]
 
     if not module_files:
         sys.exit(0)
 
-    """Following copied (with minor edits) from hooks.py:check_commit_msg_relnote_for_current_txt"""
     """Check if the commit contain the 'Relnote:' stanza."""
-    field = 'Relnote'
-    regex = fr'^{field}: .+$'
-    check_re = re.compile(regex, re.IGNORECASE)
-
-    found = []
-    for line in args.commit.splitlines():
-        if check_re.match(line):
-            found.append(line)
-
-    if not found:
+    if not _RELNOTE_RE.search(args.commit):
         print(ERROR_RELNOTE_REQUIRED.format(args.module))
         sys.exit(1)
 
@@ -24,14 +24,14 @@ Typical usage example:
 
   python validateRefactorHelper.py agpKmp
 """
-import itertools
+import io
 import logging
-import queue
+import multiprocessing
 import re
-import shutil
 import subprocess
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
 
 logger = logging.getLogger(__name__)
@@ -49,60 +49,80 @@ areNotZips = ["-x", r"**\.java", "-x", r"**\.json", "-x", r"**\.kt", "-x", r"**\
 hasNoExtension = ["-x", "manifest", "-x", "module"]
 doNotUnzip = bannedJars + areNotZips + hasNoExtension
 
-def diff(excludes):
-    return popenAndReturn(["diff", "-r", "../../out-old/dist/", "../../out-new/dist/"] + excludes)
+def diffLines(excludes):
+    return popenLines(["diff", "-r", "../../out-old/dist/", "../../out-new/dist/"] + excludes)
 
+# Only for commands with small output; subprocess.run drains stdout and stderr together, so it
+# cannot deadlock on a filled pipe the way Popen().stdout.read() can.
 def popenAndReturn(args):
     logger.debug(" ".join(args))
-    return subprocess.Popen(args, stdout=subprocess.PIPE).stdout.read().decode("utf-8").split("\n")
+    return subprocess.run(args, capture_output=True, text=True, check=False).stdout.splitlines()
 
-# Finds and unzips all files with old/new diff that _do not_ match the argument regexes.
-# Because the `diff` command doesn't have an --include, only --exclude.
-def findFilesNotMatchingWithDiffAndUnzip(*regexesToExclude):
-    excludeArgs = list(itertools.chain.from_iterable(zip(["-x"]*9, regexesToExclude)))
-    # Exclude all things that are *not* the desired zip type
-    zipsWithDiffs = diff(["-q"] + excludeArgs + doNotUnzip)
-    # Take only changed files, not new/deleted ones (the diff there is obvious)
-    zipsWithDiffs = filter(lambda s: s.startswith("Files"), zipsWithDiffs)
-    zipsWithDiffs = map(lambda s: s.split()[1:4:2], zipsWithDiffs)
-    zipsWithDiffs = itertools.chain.from_iterable(zipsWithDiffs)  # flatten
-    workQueueOfZips = queue.LifoQueue()
-    for it in zipsWithDiffs: workQueueOfZips.put(it)
-    # And unzip them
-    # If we spam unzip commands without a break, the unzips start failing.
-    # if we wait after every Popen, the script runs very slowly
-    # So create a pool of 10 unzip workers to consume from zipsWithDiffs
-    numWorkers = 10
-    workers = []
-    for i in range(min(numWorkers, workQueueOfZips.qsize())):
-        w = threading.Thread(target=unzipWorker, args=(workQueueOfZips,))
-        w.start()
-        workers.append(w)
-    for w in workers: w.join()
+# Yields stdout line-by-line so huge diff output is never buffered into one string.
+def popenLines(args):
+    logger.debug(" ".join(args))
+    with subprocess.Popen(args, stdout=subprocess.PIPE) as process:
+        for line in io.TextIOWrapper(process.stdout, encoding="utf-8"):
+            yield line.rstrip("\n")
+
+# Finds changed files under the two roots with one quick diff pass, as (old, new) path pairs.
+# Takes only changed files, not new/deleted ones (the diff there is obvious).
+def changedFilePairs(oldRoot, newRoot):
+    pairs = []
+    for line in popenLines(["diff", "-r", "-q"] + doNotUnzip + [oldRoot, newRoot]):
+        if line.startswith("Files"):
+            parts = line.split()
+            pairs.append((parts[1], parts[3]))
+    return pairs
+
+# Finds and unzips all changed archives. We unzip in rounds because e.g. zips can contain apks,
+# and aars/apks can contain jars. The full dist trees are diffed only once; later rounds re-diff
+# just the directories the previous rounds unzipped, where nested archives can newly appear.
+def findChangedArchivesAndUnzip():
+    extensionRounds = [(".zip",), (".aar", ".apk"), (".jar", ".klib")]
+    pairs = changedFilePairs("../../out-old/dist/", "../../out-new/dist/")
+    for extensions in extensionRounds:
+        logger.info("UNZIPPING " + "/".join(extensions).replace(".", "").upper() + " FILES")
+        roundPairs = [pair for pair in pairs if pair[0].endswith(extensions)]
+        unzipAll(path for pair in roundPairs for path in pair)
+        for oldPath, newPath in roundPairs:
+            pairs += changedFilePairs(oldPath + ".unzipped/", newPath + ".unzipped/")
 
-def unzipWorker(workQueueOfZips):
-    while not workQueueOfZips.empty():
-        zipFilePath = workQueueOfZips.get(0)
-        try: shutil.rmtree(zipFilePath+".unzipped/")
-        except FileNotFoundError: pass
-        logger.debug("unzipping " + zipFilePath)
-        subprocess.Popen(["unzip", "-qq", "-o", zipFilePath, "-d", zipFilePath+".unzipped/"]).wait()
+# If we spam unzip commands without a break, the unzips start failing, and waiting on each unzip
+# serially is very slow. Hand the whole batch to xargs, which keeps 10 unzips running at a time
+# without a Python thread per archive.
+def unzipAll(zipFilePaths):
+    pathBytes = "\0".join(zipFilePaths).encode()
+    if not pathBytes: return
+    subprocess.run(
+        ["xargs", "-0", "-n", "1", "-P", "10",
+         "sh", "-c", 'rm -rf "$0".unzipped/; unzip -qq -o "$0" -d "$0".unzipped/'],
+        input=pathBytes, check=False)
 
 diffusePath = "../../prebuilts/build-tools/diffuse/diffuse-0.3.0/bin/diffuser"
 
-diffuseIsPresent = True
+# set on the first missing-diffuse failure so remaining queued jobs become no-ops
+diffuseIsMissing = threading.Event()
+
+def diffuseOneJar(jarPath):
+    if diffuseIsMissing.is_set(): return None
+    newJarPath = jarPath.replace("out-old", "out-new")
+    try: return popenAndReturn([diffusePath, "diff", "--jar", jarPath, newJarPath])
+    except FileNotFoundError:
+        diffuseIsMissing.set()
+        return None
+
 def compareWithDiffuse(listOfJars):
-    global diffuseIsPresent
-    if not diffuseIsPresent: return
-    for jarPath in list(filter(None, listOfJars)):
-        logger.info("jarpath: " + jarPath)
-        newJarPath = jarPath.replace("out-old", "out-new")
-        try: logger.info("\n".join(popenAndReturn([diffusePath, "diff", "--jar", jarPath, newJarPath])))
-        except FileNotFoundError:
-            logger.warning(f"https://github.com/JakeWharton/diffuse is not present on disk in expected location"
-                  f" ${diffusePath}. You can install it.")
-            diffuseIsPresent = False
-            return
+    jarPaths = [jarPath for jarPath in listOfJars if jarPath]
+    # each diffuse run pays a JVM startup, so run a few in parallel to amortize it; map keeps
+    # the outputs in jar order for logging
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for jarPath, output in zip(jarPaths, executor.map(diffuseOneJar, jarPaths)):
+            logger.info("jarpath: " + jarPath)
+            if output is not None: logger.info("\n".join(output))
+    if diffuseIsMissing.is_set():
+        logger.warning(f"https://github.com/JakeWharton/diffuse is not present on disk in expected location"
+              f" ${diffusePath}. You can install it.")
 
 # We might care to know whether .sha1 or .md5 files have changed, but changes in those files will
 # always be accompanied by more meaningful changes in other files, so we don"t need to show changes
@@ -120,25 +140,37 @@ excludedZips = ["-x", "*.zip", "-x", "*.jar", "-x", "*.aar", "-x", "*.apk", "-x"
 
 # These are baselined changes that we understand and know are no-ops in refactors
 # "Unskippable" changes are multi-line and can't be skipped in `diff`, so post-process
-baselinedChangesForAgpKmp = [
-    # these are new attributes being added
-    """>         "org.gradle.libraryelements": "aar",""",
-    """>         "org.gradle.jvm.environment": "android",""",
-    """>         "org.gradle.jvm.environment": "non-jvm",""",
-    """>         "org.gradle.jvm.environment": "standard-jvm",""",
-    """>       <type>aar</type>""",
-    # this attribute swap occurs alongside the above new attributes added.
-    # https://chat.google.com/room/AAAAW8qmCIs/4phaNn_gsrc
-    """<         "org.jetbrains.kotlin.platform.type": "androidJvm\"""",
-    """>         "org.jetbrains.kotlin.platform.type": "jvm\"""",
-    # name-only change; nothing resolves based on names
-    """<      "name": "releaseApiElements-published",""",
-    """>      "name": "androidApiElements-published",""",
-    """             <pre>actual typealias""",  # open bug in dackka b/339221337
-    # we are switching from our KMP sourcejars solution to the upstream one
-    """<         "org.gradle.docstype": "fake-sources",""",
-    """>         "org.gradle.docstype": "sources",""",
-]
+# Bucketed by the file extension whose diffs each change can appear in; "*" applies everywhere.
+baselinedChangesForAgpKmpByExtension = {
+    "module": [
+        # these are new attributes being added
+        """>         "org.gradle.libraryelements": "aar",""",
+        """>         "org.gradle.jvm.environment": "android",""",
+        """>         "org.gradle.jvm.environment": "non-jvm",""",
+        """>         "org.gradle.jvm.environment": "standard-jvm",""",
+        # this attribute swap occurs alongside the above new attributes added.
+        # https://chat.google.com/room/AAAAW8qmCIs/4phaNn_gsrc
+        """<         "org.jetbrains.kotlin.platform.type": "androidJvm\"""",
+        """>         "org.jetbrains.kotlin.platform.type": "jvm\"""",
+        # name-only change; nothing resolves based on names
+        """<      "name": "releaseApiElements-published",""",
+        """>      "name": "androidApiElements-published",""",
+        # we are switching from our KMP sourcejars solution to the upstream one
+        """<         "org.gradle.docstype": "fake-sources",""",
+        """>         "org.gradle.docstype": "sources",""",
+    ],
+    "pom": [
+        """>       <type>aar</type>""",
+    ],
+    "*": [
+        """             <pre>actual typealias""",  # open bug in dackka b/339221337
+    ],
+}
+baselinedChangesForAgpKmp = [change for changes in baselinedChangesForAgpKmpByExtension.values()
+                             for change in changes]
+# the same changes with the >/< markers stripped, ready to become "-I" arguments for diffutils
+strippedBaselinesForAgpKmp = tuple(
+    change.removeprefix(">").removeprefix("<") for change in baselinedChangesForAgpKmp)
 unskippableBaselinedChangesForAgpKmp = [
 # This was an AGP workaround for a dependency resolution issue for kotlin stdlib
 # https://chat.google.com/room/AAAAW8qmCIs/4phaNn_gsrc
@@ -239,14 +271,24 @@ re.compile(r"""(11,17d10|12,18d11)
 """),
 ]
 
+# diff segments start with a location-in-file header like 99,112d87
+_SEGMENT_RE = re.compile(r'(^[0-9]+[0-9acd,]*\n)', re.MULTILINE)
+
 baselines = []
 baselinedChanges = []
+baselinedChangesByExtension = {}
+baselinedChangesArgs = []
 unskippableBaselinedChanges = []
 arguments = sys.argv[1:]
 if "agpKmp" in arguments:
     arguments.remove("agpKmp"); baselines += ["agpKmp"]
     logger.info("IGNORING DIFF FOR agpKmp")
     baselinedChanges += baselinedChangesForAgpKmp
+    for extension, changes in baselinedChangesForAgpKmpByExtension.items():
+        baselinedChangesByExtension.setdefault(extension, []).extend(changes)
+    # interleave "-I" to tell diffutils to 'I'gnore the baselined lines
+    baselinedChangesArgs += [arg for stripped in strippedBaselinesForAgpKmp
+                             for arg in ("-I", stripped)]
     unskippableBaselinedChanges += unskippableBaselinedChangesForAgpKmp
     excludedFiles += ["-x", r"**\.aar.unzipped/res"]  # agp-kmp may add this empty
 if arguments:
@@ -254,18 +296,33 @@ if arguments:
     logger.error("currently recognized arguments: agpKmp")
     exit()
 
-# interleave "-I" to tell diffutils to 'I'gnore the baselined lines
-baselinedChangesArgs = list(itertools.chain.from_iterable(zip(["-I"]*99, [it.removeprefix(">").removeprefix("<") for it in baselinedChanges])))
+# union the unskippable patterns so each file's diff content is scanned once, not once per pattern
+_UNSKIPPABLE_RE = re.compile(
+    "|".join(f"(?:{it.pattern})" for it in unskippableBaselinedChanges), re.MULTILINE
+) if unskippableBaselinedChanges else None
+
+# tuples because str.startswith(tuple) checks every prefix in a single C-level call;
+# keyed by extension so a segment only tests the baselines its file type can contain
+_DEFAULT_BASELINE_PREFIXES = tuple(baselinedChangesByExtension.get("*", []))
+_BASELINE_PREFIXES_BY_EXTENSION = {
+    extension: tuple(changes) + _DEFAULT_BASELINE_PREFIXES
+    for extension, changes in baselinedChangesByExtension.items() if extension != "*"
+}
 
-def removeLinesStartingWith(listOfStrings, listOfStringsToMatchAgainst):
-    return [line for line in listOfStrings if not any(line.startswith(it) for it in listOfStringsToMatchAgainst)]
+def removeLinesStartingWith(listOfStrings, prefixesToMatchAgainst):
+    return [line for line in listOfStrings if not line.startswith(prefixesToMatchAgainst)]
 
 # removeLinesWithChangedSuffixes(["foo"], ["foo-bar"], "-bar") returns [], []
 def removeLinesWithChangedSuffixes(newStrings, oldStrings, newSuffix, oldSuffix=""):
-    possibleIndices = [i for i, string in enumerate(newStrings) if string.endswith(newSuffix)]
-    convertedMap: Dict[int, str] = {i: newStrings[i].replace(newSuffix, oldSuffix) for i in possibleIndices}
-    confirmedIndicesNew = [i for i, converted in convertedMap.items() if converted in oldStrings]
-    confirmedIndicesOld = [oldStrings.index(convertedMap[i]) for i in confirmedIndicesNew]
+    oldIndices: Dict[str, int] = {string: i for i, string in enumerate(oldStrings)}
+    confirmedIndicesNew = set()
+    confirmedIndicesOld = set()
+    for i, string in enumerate(newStrings):
+        if not string.endswith(newSuffix): continue
+        oldIndex = oldIndices.get(string.replace(newSuffix, oldSuffix))
+        if oldIndex is not None:
+            confirmedIndicesNew.add(i)
+            confirmedIndicesOld.add(oldIndex)
     resultNew = [string for i, string in enumerate(newStrings) if i not in confirmedIndicesNew]
     resultOld = [string for i, string in enumerate(oldStrings) if i not in confirmedIndicesOld]
     return resultNew, resultOld
@@ -274,57 +331,80 @@ def removeLinesWithChangedSuffixes(newStrings, oldStrings, newSuffix, oldSuffix=
 def processDiffSegment(segment, fileExtension):
     if segment == "": return ""
     lines = segment.split("\n")
-    lines = removeLinesStartingWith(lines, baselinedChanges)
-    removed = [line[1:] for line in lines if line.startswith("<")]
-    added = [line[1:] for line in lines if line.startswith(">")]
+    baselinePrefixes = _BASELINE_PREFIXES_BY_EXTENSION.get(fileExtension, _DEFAULT_BASELINE_PREFIXES)
+    lines = removeLinesStartingWith(lines, baselinePrefixes)
+    added = []
+    removed = []
+    for line in lines:
+        if line.startswith(">"): added.append(line[1:])
+        elif line.startswith("<"): removed.append(line[1:])
     if (fileExtension == "pom") and "agpKmp" in baselines:
         # Ignore artifactIds' new -jvm and -android suffixes in poms b/356612738
         added, removed = removeLinesWithChangedSuffixes(added, removed, "-jvm</artifactId>", "</artifactId>")
         added, removed = removeLinesWithChangedSuffixes(added, removed, "-android</artifactId>", "</artifactId>")
-    keptContentLines = set(">" + it for it in added).union(set("<" + it for it in removed))
+    keptContentLines = {">" + it for it in added}
+    keptContentLines.update("<" + it for it in removed)
     # Do not keep any formatting lines or the header if there is no content
     if len(keptContentLines) == 0: return ""
     # return value is based on `lines` because we want to retain ordering we may have lost during processing
     # We want to keep keptContentLines, and formatting lines like "---" and the header (which don't start with <>).
-    return "\n".join([line for line in lines if (line != "") and ((not line[0] in "<>") or line in keptContentLines)])
+    return "\n".join(line for line in lines
+                     if line and (not line.startswith(("<", ">")) or line in keptContentLines))
+
+# This function removes baselined changes from a single file's diff: the `diff -r` statement
+# line and everything until the next `diff -r` statement. Returns None if nothing remains.
+# Takes a (diffStatement, diffContent) pair so it can travel through Pool.imap in one piece.
+def processFileDiff(payload):
+    diffStatement, diffContent = payload
+    newFilePath = diffStatement[diffStatement.rfind(" ")+1:]
+    fileExtension = newFilePath[newFilePath.rfind(".")+1:]
+    if _UNSKIPPABLE_RE is not None:
+        diffContent = _UNSKIPPABLE_RE.sub("", diffContent)
+    segmentHeaders = list(_SEGMENT_RE.finditer(diffContent))
+    result = []
+    for j, segmentHeader in enumerate(segmentHeaders):
+        # a complete segment is a location-in-file header like 99,112d87 and everything until
+        # the next header. E.g.
+        # 83c70
+        # <       <artifactId>kotlinx-coroutines-core-jvm</artifactId>
+        # ---
+        # >       <artifactId>kotlinx-coroutines-core</artifactId>
+        segmentEnd = segmentHeaders[j+1].start() if j+1 < len(segmentHeaders) else len(diffContent)
+        segment = diffContent[segmentHeader.start():segmentEnd]
+        processedSegment = processDiffSegment(segment, fileExtension)
+        if processedSegment != "": result.append(processedSegment)
+    if len(result) == 0: return None
+    return newFilePath + "\n" + "\n".join(result)
+
+# Splits the streamed diff output into per-file (diffStatement, diffContent) payloads
+def fileDiffPayloads(diffOutputLines):
+    diffStatement = None
+    contentLines = []
+    for line in diffOutputLines:
+        if line.startswith("diff -r"):
+            if diffStatement is not None:
+                yield diffStatement, "\n".join(contentLines)
+            diffStatement = line
+            contentLines = []
+        else:
+            contentLines.append(line)
+    if diffStatement is not None:
+        yield diffStatement, "\n".join(contentLines)
 
 # The output of diff entails multiple files, and multiple segments per file
-# This function removes baselined changes from the entire diff output
-def processMegaDiff(inputString):
-    perFileDiffs = inputString.split("diff -r")
-    processedPerFileDiffs = []
-    for i in range(1, len(perFileDiffs)):
-        diffStatement, _, diffContent = perFileDiffs[i].partition("\n")
-        newFilePath = diffStatement.rpartition(" ")[2]
-        fileExtension = newFilePath.rpartition(".")[2]
-        for multilineBaselinedElement in unskippableBaselinedChanges:
-            diffContent = multilineBaselinedElement.sub("", diffContent)
-        diffSegments = re.split(r'(^[0-9]+[0-9acd,]*\n)', diffContent, flags=re.MULTILINE)
-        result = []
-        # every other segment is a segment header like 99,112d87; 0th is ""
-        for j in range(1, len(diffSegments)-1, 2):
-            # a complete segment is a location-in-file header and everything until the next header. E.g.
-            # 83c70
-            # <       <artifactId>kotlinx-coroutines-core-jvm</artifactId>
-            # ---
-            # >       <artifactId>kotlinx-coroutines-core</artifactId>
-            segment = diffSegments[j] + diffSegments[j+1]
-            processedSegment = processDiffSegment(segment, fileExtension)
-            if processedSegment != "": result.append(processedSegment)
-        if len(result) != 0: processedPerFileDiffs += [newFilePath + "\n" + "\n".join(result)]
-    return "\ndiff ".join(processedPerFileDiffs)
+# This generator removes baselined changes from the streamed diff output, yielding one
+# processed chunk per file so the whole diff is never held in memory at once.
+# Per-file processing is independent regex work, so fan it out over a process pool; imap keeps
+# the output ordered and streaming. Must be the "fork" context: this script runs its pipeline at
+# import time, so a spawned worker re-importing the module would rerun the whole thing.
+def processMegaDiff(diffOutputLines):
+    with multiprocessing.get_context("fork").Pool() as pool:
+        for processed in pool.imap(processFileDiff, fileDiffPayloads(diffOutputLines), chunksize=16):
+            if processed is not None: yield processed
 
-# We unzip multiple times in this order because e.g. zips can contain apks.
-# Find all zip files with a diff, e.g. the tip-of-tree-repository file, and maybe the docs zip
-logger.info("UNZIPPING ZIP FILES");
-findFilesNotMatchingWithDiffAndUnzip(r"**\.[^z][a-z]*")
-# Find all aar and apk files with a diff. The proper regex would be `.*\..*[^akpr]+.*`, but it
-# doesn"t work in difftools exclude's very limited regex syntax.
-logger.info("UNZIPPING AAR/APK FILES");
-findFilesNotMatchingWithDiffAndUnzip(r"**\.zip", r"**\.jar", r"**\.klib")
-# Find all jars and klibs and unzip them (comes after because they could be inside aars/apks).
-logger.info("UNZIPPING JAR/KLIB FILES");
-findFilesNotMatchingWithDiffAndUnzip(r"**\.zip", r"**\.aar", r"**\.apk")
+# Find all zip/aar/apk/jar/klib files with a diff, e.g. the tip-of-tree-repository file, and
+# maybe the docs zip, and unzip them round by round
+findChangedArchivesAndUnzip()
 
 # now find all diffs in classes.jars
 # TODO(375636734) Disabled because this tracks internal methods' diffs
@@ -332,8 +412,8 @@ findFilesNotMatchingWithDiffAndUnzip(r"**\.zip", r"**\.aar", r"**\.apk")
 # logger.info("classes.jar s: " + str(classesJarsWithDiffs))
 # compareWithDiffuse(classesJarsWithDiffs)
 
-# Now find all diffs in non-zipped files
+# Now find all diffs in non-zipped files, streaming each file's processed diff as it is ready
 finalExcludes = excludedHashes + excludedFiles + excludedZips + baselinedChangesArgs
-finalDiff = "\n".join(diff(finalExcludes))
-finalDiff = processMegaDiff(finalDiff)
-print(finalDiff)
+for i, perFileDiff in enumerate(processMegaDiff(diffLines(finalExcludes))):
+    sys.stdout.write(("\ndiff " if i else "") + perFileDiff)
+sys.stdout.write("\n")